@@ -22,10 +22,30 @@ along with this program. If not, see <http://www.gnu.org/licenses/>.
 import argparse
 import configparser
 import re
-import requests
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from itertools import chain
 from urllib.parse import unquote
-from xml.etree import ElementTree as ET
 from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+# Default amount of DELETE requests to have in flight at the same time
+DELETE_WORKERS = 8
+
+# Only request the properties we actually use, an empty PROPFIND body makes the server return all of them
+PROPFIND_BODY = b'<?xml version="1.0"?><d:propfind xmlns:d="DAV:"><d:prop><d:getlastmodified/></d:prop></d:propfind>'
+
+# Fully qualified (Clark notation) names of the WebDAV elements we look up, avoiding namespace prefix resolution on every lookup
+DAV_RESPONSE = "{DAV:}response"
+DAV_HREF = "{DAV:}href"
+DAV_LAST_MODIFIED_PATH = "{DAV:}propstat/{DAV:}prop/{DAV:}getlastmodified"
+
+# A single file or folder in the trashbin. A tuple is a lot smaller than a dict per item on large trashbins.
+# href is kept exactly as received from the server (percent-encoded), href_decoded is the human-readable version.
+TrashItem = namedtuple("TrashItem", ["href", "href_decoded", "filename", "getlastmodified", "age_in_days"])
+
+# Month abbreviations as used in HTTP dates, mapped to their number
+HTTP_DATE_MONTHS = {month: number for (number, month) in enumerate(("Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"), 1)}
 
 
 def read_config(config_file):
@@ -42,75 +62,145 @@ def construct_trashbin_url(base_url, username):
     return f"{base_url}/remote.php/dav/trashbin/{username}/trash"
 
 
-def list_trashbin(trashbin_url, username, password, depth):
+def parse_http_date(value):
+    """
+    Parse an HTTP date (RFC 1123, e.g. "Sun, 06 Nov 1994 08:49:37 GMT") into a timezone aware datetime.
+
+    The fixed-width GMT form servers send is sliced apart directly, anything else is left to email.utils.
+    Raises ValueError if the value can't be parsed.
+    """
+    if len(value) == 29 and value.endswith(" GMT"):
+        try:
+            return datetime(int(value[12:16]), HTTP_DATE_MONTHS[value[8:11]], int(value[5:7]), int(value[17:19]), int(value[20:22]), int(value[23:25]), tzinfo=timezone.utc)
+        except (KeyError, ValueError):
+            pass
+
+    try:
+        parsed = parsedate_to_datetime(value)
+    except TypeError:
+        # Python before 3.10 raises TypeError instead of ValueError on unparseable dates
+        raise ValueError(f"Invalid HTTP date: {value}") from None
+
+    # Dates without timezone information are in GMT
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed
+
+
+def combine_patterns(regexes):
+    """
+    Combine compiled patterns into a single alternation, with a named group per pattern (p0, p1, ...).
+
+    Matching the combined pattern tells which pattern is the first one to match, in a single call.
+    Returns None if any of the patterns has groups or inline flags of its own, as combining those would change their meaning.
+    """
+    if any(regex.groups or regex.flags != re.UNICODE for regex in regexes):
+        return None
+
+    return re.compile("|".join(f"(?P<p{index}>{regex.pattern})" for (index, regex) in enumerate(regexes)))
+
+
+def list_trashbin(session, trashbin_url, depth):
     """
     Fetch the list of items in the Nextcloud trash bin using WebDAV.
 
-    Returns a list of dictionaries with file details including synthesized filename.
+    Yields TrashItem tuples with file details including synthesized filename, while the response is still being received.
     """
-    response = requests.request("PROPFIND", trashbin_url, auth=(username, password), headers={"Depth": str(depth)})
+    response = session.request("PROPFIND", trashbin_url, data=PROPFIND_BODY, headers={"Depth": str(depth), "Content-Type": "application/xml"}, stream=True)
     if response.status_code != 207:
         print(f"Failed to list trashbin: {response.status_code}, {response.text}")
-        return []
+        return
 
-    # Parse XML response
-    tree = ET.fromstring(response.content)
+    # Only import the XML parser when actually needed, so --help and configuration errors don't pay for it.
+    # Use lxml with precompiled XPath expressions when it is available, as that is faster than the standard library.
+    # Fall back to ElementTree if it's not installed, so it does not become a hard dependency.
     namespaces = {'d': 'DAV:'}
-    items = []
+    try:
+        from lxml import etree as lxml_etree
+        xpath_href = lxml_etree.XPath("string(d:href)", namespaces=namespaces, smart_strings=False)
+        xpath_last_modified = lxml_etree.XPath("string(d:propstat/d:prop/d:getlastmodified)", namespaces=namespaces, smart_strings=False)
+    except ModuleNotFoundError:
+        lxml_etree = None
+        from xml.etree import ElementTree as ET
+
+    # Parse XML response incrementally, one <d:response> element at a time, so the whole document is never held in memory
+    response.raw.decode_content = True
+    root = None
+
+    # Ages are in whole days, so a single reference time for the entire listing is precise enough
+    current_time = datetime.now(timezone.utc)
+
+    if lxml_etree:
+        elements = lxml_etree.iterparse(response.raw, events=("end",), tag=DAV_RESPONSE)
+    else:
+        # The start event of the document root is needed as well, to detach processed elements from it
+        elements = ET.iterparse(response.raw, events=("start", "end"))
+
+    for (event, element) in elements:
+        if event == "start":
+            if root is None:
+                root = element
+            continue
 
-    for response in tree.findall('d:response', namespaces):
-        # Extract href
-        href = response.find('d:href', namespaces).text
-        if not href:
+        if element.tag != DAV_RESPONSE:
             continue
 
-        # Extract properties
-        properties = {}
-        for prop in response.findall('.//d:prop', namespaces):
-            for child in prop:
-                tag_name = child.tag.split("}")[-1]  # Strip namespace
-                properties[tag_name] = child.text
+        # Detach everything parsed before this element from the document, as clearing elements still leaves them
+        # attached to the root. The current element is still readable after being detached.
+        if lxml_etree:
+            while element.getprevious() is not None:
+                del element.getparent()[0]
+        else:
+            root.clear()
+
+        # Extract href and the last modified date, the only property we asked for
+        if lxml_etree:
+            href = xpath_href(element)
+            last_modified_text = xpath_last_modified(element)
+        else:
+            href = element.findtext(DAV_HREF)
+            last_modified_text = element.findtext(DAV_LAST_MODIFIED_PATH)
 
-        # Add href to properties
-        properties['href'] = href
+        if not href:
+            element.clear()
+            continue
+
+        # Keep the href as sent by the server (still percent-encoded) to build URLs with, as decoding it would break on
+        # names containing '%', '#' or '?'. Decode it only once, for display, and derive the filename from it (remove
+        # trailing slash for folders).
+        href_decoded = unquote(href)
+        filename = href_decoded.rstrip("/").rpartition("/")[2]
 
-        # Derive filename from href and add to properties (remove trailing slash for folders)
-        properties['filename'] = unquote(href.rstrip("/").split("/")[-1])
         # Parse the getlastmodified date to calculate the age in days
         # Files in the trashbin root end in .d<unixtime> which is the deletion timestamp, but lastmodified
         # is exactly the same value so we can ignore it. It's not present on files in subfolders so not reliable
         # as an 'deletion age' determination.
-        if 'getlastmodified' in properties and properties['getlastmodified']:
+        age_in_days = None
+        if last_modified_text:
             try:
-                # Parse the last modified timestamp
-                last_modified = datetime.strptime(
-                    properties['getlastmodified'], "%a, %d %b %Y %H:%M:%S %Z"
-                ).replace(tzinfo=timezone.utc)
+                # Parse the last modified timestamp (an RFC 1123 HTTP date, always in GMT)
+                last_modified = parse_http_date(last_modified_text)
 
                 # Calculate age in days
-                current_time = datetime.now(timezone.utc)
                 age_in_days = (current_time - last_modified).days
-                properties['age_in_days'] = age_in_days
             except ValueError:
-                print(f"Could not parse getlastmodified: {properties['getlastmodified']}")
-                properties['age_in_days'] = None
-        else:
-            properties['age_in_days'] = None
+                print(f"Could not parse getlastmodified: {last_modified_text}")
 
-        items.append(properties)
+        # Release the parsed element, everything needed from it has been extracted
+        element.clear()
 
-    return items
+        yield TrashItem(href, href_decoded, filename, last_modified_text, age_in_days)
 
 
-def delete_item(base_url, href, username, password):
-    """Delete an item using its WebDAV href."""
+def delete_item(session, base_url, href):
+    """Delete an item using its (percent-encoded) WebDAV href."""
     delete_url = f"{base_url}{href}"
-    response = requests.request("DELETE", delete_url, auth=(username, password))
+    response = session.request("DELETE", delete_url)
 
     return (response.status_code == 204, response.status_code, response.text)
 
 
-def purge_files(base_url, username, password, patterns, default_min_age, threshold, dry_run, force, verbose, progress, depth):
+def purge_files(base_url, username, password, patterns, threshold, dry_run, force, verbose, progress, depth, workers):
     """
     Delete files from the trash bin matching any of the specified patterns.
 
@@ -119,13 +209,14 @@ def purge_files(base_url, username, password, patterns, default_min_age, thresho
         base_url (str): Base URL for the WebDAV server.
         username (str): Username for authentication.
         password (str): Password for authentication.
-        patterns (list): ConfigParser Section objects with regex patterns for filename matching and optional minimum_age.
-        default_min_age (int): Minimum age in days of the file.
+        patterns (list): Tuples of a compiled regex for filename matching and the minimum age in days for files matching it.
         threshold (int): Only delete files if less than this amount of matching files is found (unless forced).
         dry_run (bool): If True, don't actually delete files.
         force (bool): Delete files regardless of how many were found (ignore threshold)
         verbose (int): Verbosity level.
         progress (bool): If True, display a progress bar.
+        depth (int): Amount of subdirectory levels to search through.
+        workers (int): Amount of files to delete at the same time.
     """
     # Set up tqdm progress bar if requested (can't combine with dry run)
     if progress and not dry_run:
@@ -150,43 +241,74 @@ def purge_files(base_url, username, password, patterns, default_min_age, thresho
     if verbose >= 2:
         print(f"Constructed trashbin URL: {trashbin_url}")
 
-    items = list_trashbin(trashbin_url, username, password, depth)
-    if not items:
+    # Only import requests when actually needed, so --help and configuration errors don't pay for its import time.
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    # Use a single session for all WebDAV calls, so the connection (and TLS handshake) is reused between requests
+    session = requests.Session()
+    session.auth = (username, password)
+    adapter = HTTPAdapter(pool_maxsize=workers)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+
+    # Collect the matching items per pattern, in a list kept right next to it
+    compiled_patterns = [(regex, min_age, []) for (regex, min_age) in patterns]
+
+    # Try all patterns at once where possible, so non-matching files (usually the bulk of them) only take a single match call
+    combined_regex = combine_patterns([regex for (regex, _, _) in compiled_patterns])
+
+    # Files younger than the lowest minimum age can't be selected by any pattern
+    lowest_min_age = min(min_age for (_, min_age, _) in compiled_patterns)
+
+    # Filter items based on patterns, in a single pass while the trashbin listing streams in: each item goes to the
+    # first pattern it satisfies, so it is not checked against any of the other patterns anymore, as it's already
+    # selected for deletion
+    item_count = 0
+    for item in list_trashbin(session, trashbin_url, depth):
+        item_count += 1
+
+        # Check the age first, it's a lot cheaper than running the patterns on the filename
+        if item.age_in_days is None or item.age_in_days < lowest_min_age:
+            continue
+
+        candidate_patterns = compiled_patterns
+        if combined_regex:
+            match = combined_regex.match(item.filename)
+            if not match:
+                continue
+            # None of the patterns before the one that matched can match this file, skip straight to it
+            candidate_patterns = compiled_patterns[int(match.lastgroup[1:]):]
+
+        for (regex, min_age, section_items) in candidate_patterns:
+            if item.age_in_days >= min_age and regex.match(item.filename):
+                section_items.append(item)
+                break
+
+    if not item_count:
         print("Trashbin is empty or failed to retrieve contents.")
         return
 
     if verbose:
-        print(f"Found {len(items)} items in the trashbin.")
-
-    # Filter items based on patterns
-    matching_section_items = {}
-    for pattern in patterns:
-        matching_section_items[pattern.get("pattern")] = []
-
-        # Use per-pattern minimum age if specified, fall back to default if not
-        min_age = pattern.getint("minimum_age", fallback=default_min_age)
-
-        # Iterate over a copy of 'items' as we will be modifying the real list in-place
-        for item in items[:]:
-            if re.match(pattern.get("pattern"), item["filename"]):
-                if item['age_in_days'] is not None and item["age_in_days"] >= min_age:
-                    if verbose >= 3:
-                        print(f"{item['getlastmodified']} is older than {default_min_age} ({item['age_in_days']} days)")
-                    matching_section_items[pattern.get("pattern")].append(item)
-                    # Remove the file from the list of files to check for other patterns, as it's already selected for deletion
-                    items.remove(item)
-        if verbose >= 2:
-            print(f"{len(matching_section_items[pattern.get('pattern')])} items match the patterns {pattern.get('pattern')} with minimum age of {min_age} days.")
-
-    # Flatten section-separated dict of matching items into a single list
-    matching_items = [item for sublist in matching_section_items.values() for item in sublist]
+        print(f"Found {item_count} items in the trashbin.")
+
+    if verbose >= 2:
+        for (regex, min_age, section_items) in compiled_patterns:
+            # Report on the individual items afterwards, keeping the filter loop above free of output
+            if verbose >= 3:
+                for item in section_items:
+                    print(f"{item.getlastmodified} is older than {min_age} ({item.age_in_days} days)")
+            print(f"{len(section_items)} items match the patterns {regex.pattern} with minimum age of {min_age} days.")
+
+    # Flatten the per-pattern lists of matching items into a single list
+    matching_items = list(chain.from_iterable(section_items for (_, _, section_items) in compiled_patterns))
 
     # Bail out if we are over the threshold, unless forced to continue
     if not force and len(matching_items) > threshold:
         print(f"Threshold of {threshold} files exceeded ({len(matching_items)} files to be deleted). Aborting operation.")
         print("Files that would be deleted:")
         for item in matching_items:
-            print(f"- {item['filename']}")
+            print(f"- {item.filename}")
         return
 
     if verbose:
@@ -196,34 +318,81 @@ def purge_files(base_url, username, password, patterns, default_min_age, thresho
     if not len(matching_items):
         return
 
-    # Convert list to tqdm if requested (can't combine with dry run)
+    # Disable verbose when requesting progress bar, below prints would interfere with output (can't combine with dry run)
     if progress and not dry_run:
-        matching_items = tqdm(matching_items, desc="Processing items", unit="file", ascii=' █', dynamic_ncols=True)
-
-        # Disable verbose when requesting progress bar, below prints would interfere with output
         verbose = 0
 
     if verbose:
         print(f"Deleting {len(matching_items)} matching items.")
-    for item in matching_items:
-        href = unquote(item["href"])
-        if not dry_run:
-            if verbose >= 2:
-                print(f"Deleting {item['filename']}...")
 
-            # If progress bar was requested, update the bar to show the current file name being deleted.
-            if progress:
-                matching_items.set_description(f"{item['filename'][:40]:40}")
+    if dry_run:
+        for item in matching_items:
+            print(f"Dry run - not deleting {item.filename}")
+        return
+
+    # Delete one file at a time when reporting on every single file, so the output stays readable
+    if verbose >= 2:
+        for item in matching_items:
+            href = item.href_decoded
+            print(f"Deleting {item.filename}...")
 
             # Delete the file
-            (success, status_code, response_text) = delete_item(base_url, href, username, password)
+            (success, status_code, response_text) = delete_item(session, base_url, item.href)
             if success:
-                if verbose:
-                    print(f"Deleted: {href}")
+                print(f"Deleted: {href}")
             else:
                 print(f"Failed to delete {href}: {status_code}, {response_text}")
-        else:
-            print(f"Dry run - not deleting {item['filename']}")
+        return
+
+    # Otherwise keep several deletions in flight at once, as every single one is a separate WebDAV round trip
+    if progress:
+        progress_bar = tqdm(total=len(matching_items), desc="Processing items", unit="file", ascii=' █', dynamic_ncols=True)
+
+    remaining_items = iter(matching_items)
+    pending = {}
+    error = None
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while True:
+            # Only hand out as many deletions as there are workers, so on Ctrl-C or an error only the ones already
+            # in flight get finished, instead of everything that's left. Stop handing out new ones after an error,
+            # just like deleting one file at a time would have.
+            while error is None and len(pending) < workers:
+                item = next(remaining_items, None)
+                if item is None:
+                    break
+                pending[executor.submit(delete_item, session, base_url, item.href)] = item
+
+            if not pending:
+                break
+
+            (completed, _) = wait(pending, return_when=FIRST_COMPLETED)
+            for future in completed:
+                item = pending.pop(future)
+                href = item.href_decoded
+
+                # If progress bar was requested, update the bar to show the file name that was just processed.
+                if progress:
+                    progress_bar.set_description(f"{item.filename[:40]:40}")
+                    progress_bar.update()
+
+                # Keep the first error to raise once the deletions in flight are done and reported
+                try:
+                    (success, status_code, response_text) = future.result()
+                except Exception as e:
+                    error = error or e
+                    continue
+
+                if success:
+                    if verbose:
+                        print(f"Deleted: {href}")
+                else:
+                    print(f"Failed to delete {href}: {status_code}, {response_text}")
+
+    if progress:
+        progress_bar.close()
+
+    if error:
+        raise error
 
 
 def main():
@@ -236,8 +405,11 @@ def main():
     parser.add_argument("-v", "--verbose", action="count", help="Enable verbose output.", default=0)
     parser.add_argument("-C", "--progress", action="store_true", help="Show progress bar (disables verbose output).")
     parser.add_argument("-D", "--depth", type=int, help="Amount of subdirectory levels to search through. Defaults to 1 (only files directly in the trashbin).", default=1)
+    parser.add_argument("-W", "--workers", type=int, help=f"Amount of files to delete at the same time. Defaults to {DELETE_WORKERS}.", default=DELETE_WORKERS)
 
     args = parser.parse_args()
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
 
     for config_file in args.files:
         if args.verbose:
@@ -273,17 +445,21 @@ def main():
                 print(f"No patterns specified in {config_file}. Skipping.")
                 continue
 
+            # Compile each pattern once up front, so invalid ones are reported before contacting the server.
+            # Use per-pattern minimum age if specified, fall back to default if not.
+            compiled_patterns = [(re.compile(section.get("pattern")), section.getint("minimum_age", fallback=min_age)) for section in patterns]
+
             # Print configuration summary
             if args.verbose:
                 print("Purging files matching:")
-                pattern_list = '", "'.join(f"{section['pattern']}" for section in patterns)
+                pattern_list = '", "'.join(f"{regex.pattern}" for (regex, _) in compiled_patterns)
                 print(f' - File name patterns: "{pattern_list}"')
                 if not args.force:
                     print(f" - Maximum threshold of {threshold} files")
                 print(f" - Minimum age of {min_age} days")
 
             # Purge the files matching the requirements
-            purge_files(base_url, username, password, patterns, min_age, threshold, args.dry_run, args.force, args.verbose, args.progress, args.depth)
+            purge_files(base_url, username, password, compiled_patterns, threshold, args.dry_run, args.force, args.verbose, args.progress, args.depth, args.workers)
 
         except Exception as e:
             print(f"Error processing {config_file}: {e}")